@@ -1,23 +1,60 @@
-import paho.mqtt.publish as publish
-import json
+import atexit
+import logging
+
+import paho.mqtt.client as mqtt
+
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def setup(hostname="localhost", port=1883, keepalive=60, **kwargs):
+    """Connect a long lived MQTT client and start its network thread.
+    Extra keyword arguments are passed to mqtt.Client"""
+    global _client
+    if _client is not None:
+        return _client
+    # Only kept once connected, so a broker that is down at the first event
+    # is retried on the next one instead of leaving a dead client behind
+    client = mqtt.Client(**kwargs)
+    client.connect(hostname, port, keepalive)
+    client.loop_start()
+    _client = client
+    atexit.register(teardown)
+    return _client
+
+
+def teardown():
+    """Flush and disconnect the client created by setup(). Called by
+    watch --ipc when a callback process stops, as atexit handlers don't
+    run there"""
+    global _client
+    if _client is None:
+        return
+    _client.disconnect()
+    _client.loop_stop()
+    _client = None
+
+
+def publish(client, topic, payload):
+    # QoS 0 publishes are only queued, the network thread writes them out
+    info = client.publish(topic, payload, qos=0)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        logger.warning("Dropped message for %s: %s",
+                       topic, mqtt.error_string(info.rc))
+
 
 def to_mqtt(event):
-    pid, table, payload = event
-    payload_obj = json.loads(payload)
-    topic = payload_obj.get('table', 'events')
-
-    publish.single(
-        # TODO, better topics
-        topic=topic,
-        payload=payload,
-        qos=0,
-        # retain=False,
-        # hostname="localhost",
-        # port=1883,
-        # client_id="",
-        # keepalive=60,
-        # will=None,
-        # auth=None,
-        # tls=None,
-        #protocol=mqtt.MQTTv311
-    )
+    # The triggers notify on a channel named after the table, which is
+    # the topic, so the payload is forwarded without being parsed
+    pid, channel, payload = event
+    publish(_client or setup(), channel, payload)
+
+
+def to_mqtt_batch(events):
+    """Publish every event drained in one poll (watch --batch) in a tight
+    loop, leaving the network thread to flush them together"""
+    client = _client or setup()
+    for pid, channel, payload in events:
+        publish(client, channel, payload)
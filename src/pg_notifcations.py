@@ -1,17 +1,31 @@
 #!/usr/bin/env python
 
+import asyncio
 import importlib
-import select
+import os
+import selectors
+import signal
+import traceback
 from contextlib import contextmanager
-from functools import partial
-from multiprocessing import Process, Queue
+from functools import lru_cache, partial
+from multiprocessing import Pipe, Process, Queue
+from queue import Full
 
 import click
 import psycopg2
 import psycopg2.extensions
 from jinja2 import Template
+from psycopg2.extensions import quote_ident
 from psycopg2.extras import RealDictCursor
 
+# psycopg 3 is preferred for listening, it queues notifications in C and has
+# native async support. psycopg2 is still used for everything else.
+try:
+    import psycopg
+    from psycopg import sql
+except ImportError:
+    psycopg = None
+
 
 TRIGGER_FUNCTION = """
     CREATE OR REPLACE FUNCTION notify_event() RETURNS TRIGGER AS $$
@@ -31,15 +45,92 @@ TRIGGER_FUNCTION = """
                 data = row_to_json(NEW);
             END IF;
 
-            -- Contruct the notification as a JSON string.
+            -- Nothing to notify when an UPDATE didn't change the row. Rows are
+            -- compared as text, like notify_statement_event() does, since
+            -- json, point or xml columns have no equality operator
+            IF (TG_OP = 'UPDATE' AND row_to_json(OLD)::text = data::text) THEN
+                RETURN NULL;
+            END IF;
+
+            -- Contruct the notification as a JSON string. 'data' is an array
+            -- of rows, as sent by notify_statement_event()
             notification = json_build_object(
                             'table',TG_TABLE_NAME,
                             'action', TG_OP,
-                            'data', data);
+                            'data', json_build_array(data));
+
+
+            -- Execute pg_notify(channel, notification), on a channel named
+            -- after the table so listeners can route without parsing
+            PERFORM pg_notify(TG_TABLE_NAME,notification::text);
+
+            -- Result is ignored since this is an AFTER trigger
+            RETURN NULL;
+        END;
+
+    $$ LANGUAGE plpgsql;
+"""
+
+# pg_notify deduplicates payloads within a transaction by comparing each new
+# one against the ones already queued, so a NOTIFY per row gets quadratic
+# on bulk statements. This sends one notification per statement instead,
+# split in as many as needed to keep each payload under the 8000 bytes limit.
+# Transition tables need PostgreSQL 10.
+STATEMENT_TRIGGER_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_statement_event() RETURNS TRIGGER AS $$
+
+        DECLARE
+            query text;
+            row_json text;
+            chunk text = '';
+            envelope int;
 
+        BEGIN
 
-            -- Execute pg_notify(channel, notification)
-            PERFORM pg_notify('events',notification::text);
+            -- Select the rows touched by the statement from the transition
+            -- tables: old_rows for DELETE, new_rows for INSERT or UPDATE.
+            -- Like notify_event(), rows an UPDATE didn't change are skipped.
+            IF (TG_OP = 'DELETE') THEN
+                query = 'SELECT row_to_json(o)::text FROM old_rows o';
+            ELSIF (TG_OP = 'UPDATE') THEN
+                query = 'SELECT row_to_json(n)::text FROM new_rows n
+                         EXCEPT ALL
+                         SELECT row_to_json(o)::text FROM old_rows o';
+            ELSE
+                query = 'SELECT row_to_json(n)::text FROM new_rows n';
+            END IF;
+
+            -- Size of a notification without any row in 'data'
+            envelope = octet_length(json_build_object(
+                            'table',TG_TABLE_NAME,
+                            'action', TG_OP,
+                            'data', json_build_array())::text);
+
+            -- NOTIFY payloads must be shorter than 8000 bytes, send the rows
+            -- gathered so far before the next one would go over it
+            FOR row_json IN EXECUTE query LOOP
+                IF chunk <> '' AND envelope + octet_length(chunk) + 1
+                                   + octet_length(row_json) >= 8000 THEN
+                    PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+                                        'table',TG_TABLE_NAME,
+                                        'action', TG_OP,
+                                        'data', ('[' || chunk || ']')::json)::text);
+                    chunk = '';
+                END IF;
+                IF chunk = '' THEN
+                    chunk = row_json;
+                ELSE
+                    chunk = chunk || ',' || row_json;
+                END IF;
+            END LOOP;
+
+            -- Nothing left when the statement didn't affect any row
+            IF chunk <> '' THEN
+                PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+                                    'table',TG_TABLE_NAME,
+                                    'action', TG_OP,
+                                    'data', ('[' || chunk || ']')::json)::text);
+            END IF;
 
             -- Result is ignored since this is an AFTER trigger
             RETURN NULL;
@@ -48,31 +139,56 @@ TRIGGER_FUNCTION = """
     $$ LANGUAGE plpgsql;
 """
 
-ADD_TRIGGER_TO_TABLE = Template("""\
-DROP TRIGGER  IF EXISTS {{table}}_notify_event ON {{table}};
-CREATE TRIGGER {{table}}_notify_event
+# Names are expected to be quoted with quote_ident. Both kinds of triggers
+# are dropped so a table can be switched from one mode to the other.
+DROP_TRIGGERS = """\
+DROP TRIGGER  IF EXISTS {{trigger}} ON {{table}};
+DROP TRIGGER  IF EXISTS {{insert_trigger}} ON {{table}};
+DROP TRIGGER  IF EXISTS {{update_trigger}} ON {{table}};
+DROP TRIGGER  IF EXISTS {{delete_trigger}} ON {{table}};
+"""
+
+ADD_TRIGGER_TO_TABLE = Template(DROP_TRIGGERS + """\
+CREATE TRIGGER {{trigger}}
 AFTER INSERT OR UPDATE OR DELETE ON {{table}}
     FOR EACH ROW EXECUTE PROCEDURE notify_event();
-    COMMIT;
+""")
+
+# A trigger with transition tables can only fire on a single event
+ADD_STATEMENT_TRIGGERS_TO_TABLE = Template(DROP_TRIGGERS + """\
+CREATE TRIGGER {{insert_trigger}}
+AFTER INSERT ON {{table}}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_statement_event();
+CREATE TRIGGER {{update_trigger}}
+AFTER UPDATE ON {{table}}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_statement_event();
+CREATE TRIGGER {{delete_trigger}}
+AFTER DELETE ON {{table}}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_statement_event();
 """)
 
 
-GET_TABLE_TRIGGERS = Template("""\
+GET_TABLE_TRIGGERS = """\
 SELECT event_object_table
       ,trigger_name
       ,event_manipulation
       ,action_statement
       ,action_timing
 FROM  information_schema.triggers
-WHERE event_object_table = '{{ table }}'
+WHERE event_object_table = ANY(%s)
 ORDER BY event_object_table
      ,event_manipulation
-""")
+"""
 
 
 def get_associated_triggers(conn, table):
     """Given a table name, return a list of triggers"""
-    sql = GET_TABLE_TRIGGERS.render(table=table)
+    with cursor_wrapper(conn) as cursor:
+        cursor.execute(GET_TABLE_TRIGGERS, ([table], ))
+        return cursor.fetchall()
 
 def get_tables(ctx):
     """Get tables of current schema"""
@@ -80,9 +196,8 @@ def get_tables(ctx):
         cursor.execute("""
         SELECT table_name FROM information_schema.tables
         WHERE table_schema='public'
-        """.format(**locals()))
-        data = [row[0] for row in cursor.fetchall()]
-        return data
+        """)
+        return frozenset(row[0] for row in cursor.fetchall())
 
 @contextmanager
 def cursor_wrapper(conn, cursor_factory=psycopg2.extensions.cursor):
@@ -90,8 +205,49 @@ def cursor_wrapper(conn, cursor_factory=psycopg2.extensions.cursor):
     Context manager to generate a cursor
     """
     cursor = conn.cursor(cursor_factory=cursor_factory)
-    yield cursor
-    cursor.close()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+def connect_listener(dsn):
+    """Open an autocommit connection for LISTEN, with psycopg 3 if available"""
+    if psycopg is not None:
+        return psycopg.connect(dsn, autocommit=True)
+    conn = psycopg2.connect(dsn)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+class CliCtx(object):
+    """State shared by the commands, with fixed attribute slots"""
+    __slots__ = ('conn', 'dbname', 'verbose', 'get_cursor',
+                 'dsn', 'listen_conn', 'notify_dsn', 'notify_conn')
+
+    def __init__(self, conn, dbname, verbose, dsn, notify_dsn=None):
+        self.conn = conn
+        self.dbname = dbname
+        self.verbose = verbose
+        self.get_cursor = partial(cursor_wrapper, conn)
+        self.dsn = dsn
+        self.listen_conn = None
+        self.notify_dsn = notify_dsn
+        self.notify_conn = None
+
+    def get_listen_conn(self):
+        """Connection used only for LISTEN, so other queries don't delay
+        notification delivery. Opened on first use"""
+        if self.listen_conn is None:
+            self.listen_conn = connect_listener(self.dsn)
+        return self.listen_conn
+
+    def get_notify_conn(self):
+        """Connection used to send NOTIFYs, dedicated if --notify-conn
+        was given"""
+        if self.notify_dsn is None:
+            return self.conn
+        if self.notify_conn is None:
+            self.notify_conn = psycopg2.connect(self.notify_dsn)
+        return self.notify_conn
 
 @click.group()
 @click.option('--verbose',
@@ -101,85 +257,421 @@ def cursor_wrapper(conn, cursor_factory=psycopg2.extensions.cursor):
               #prompt='Connection',
               default="dbname=nguru",
               help='The connection string')
+@click.option('--notify-conn',
+              default=None,
+              help='Connection string for a dedicated connection sending NOTIFYs')
 @click.pass_context
-def cli(ctx, conn, verbose):
+def cli(ctx, conn, verbose, notify_conn):
     try:
-        ctx.obj['CONN'] = psycopg2.connect(conn)
+        connection = psycopg2.connect(conn)
     except psycopg2.OperationalError:
         raise click.BadArgumentUsage("Error connecting to postgres with conn={}".format(conn))
-    ctx.obj['DBNAME'] = 'nguru'
-    ctx.obj['VERBOSE'] = verbose
-
-    ctx.obj['get_cursor'] = partial(cursor_wrapper, ctx.obj.CONN)
+    ctx.obj = CliCtx(conn=connection, dbname='nguru', verbose=verbose,
+                     dsn=conn, notify_dsn=notify_conn)
+
+def trigger_names(table, cursor):
+    """Quoted names of the triggers install creates on table"""
+    return dict(
+        trigger=quote_ident(table + '_notify_event', cursor),
+        insert_trigger=quote_ident(table + '_notify_insert', cursor),
+        update_trigger=quote_ident(table + '_notify_update', cursor),
+        delete_trigger=quote_ident(table + '_notify_delete', cursor),
+    )
 
 @cli.command()
+@click.option('--per-row',
+              is_flag=True,
+              help='Send a notification per row instead of per statement '
+                   '(needed before PostgreSQL 10). The payload is the same, '
+                   'with a single row in data')
 @click.argument('tables', nargs=-1)
 @click.pass_context
-def install(ctx, tables):
-    not_found = set(tables).difference(set(get_tables(ctx)))
+def install(ctx, per_row, tables):
+    known = get_tables(ctx)
+    not_found = [table for table in tables if table not in known]
     if not_found:
-        tables = ','.join(list(not_found))
+        tables = ','.join(not_found)
         raise click.BadArgumentUsage("Tables {} could not be found".format(tables))
-    for table in tables:
-        sql = ADD_TRIGGER_TO_TABLE.render(table=table)
-        cursor = ctx.obj['CONN'].cursor()
-        if ctx.obj['VERBOSE']:
-            click.echo(sql)
-        fail = cursor.execute(sql)
-
-        if fail:
-            print(fail)
+    if not tables:
+        return
+    # A single round trip, committed (or rolled back) as one transaction
+    with ctx.obj.conn as conn, conn.cursor() as cursor:
+        if per_row:
+            function, template = TRIGGER_FUNCTION, ADD_TRIGGER_TO_TABLE
         else:
-            click.echo("OK: {}".format(table))
+            function = STATEMENT_TRIGGER_FUNCTION
+            template = ADD_STATEMENT_TRIGGERS_TO_TABLE
+        sql = function + "".join(
+            template.render(table=quote_ident(table, cursor),
+                            **trigger_names(table, cursor))
+            for table in tables
+        )
+        if ctx.obj.verbose:
+            click.echo(sql)
+        cursor.execute(sql)
+    for table in tables:
+        click.echo("OK: {}".format(table))
 
 def get_table_triggers(ctx, tables):
+    """Map each table with triggers to its (name, event, timing) tuples"""
     with ctx.obj.get_cursor() as cursor:
         retval = {}
-        for table in tables:
-            sql = GET_TABLE_TRIGGERS.render(table=table)
-            cursor.execute(sql)
-            click.echo(sql)
-            if cursor.rowcount < 1:
-                continue
-            for _, trigger_name, event, action, when in cursor.fetchall():
-                events = retval.setdefault(event, [])
-                events.append((action, when))
+        # Every table in one query rather than a round trip per table
+        cursor.execute(GET_TABLE_TRIGGERS, (list(tables), ))
+        if ctx.obj.verbose:
+            click.echo(cursor.query)
+        for table, trigger_name, event, action, when in cursor.fetchall():
+            triggers = retval.setdefault(table, [])
+            triggers.append((trigger_name, event, when))
         return retval
 
 @cli.command()
 @click.pass_context
 def list_tables(ctx):
 
-    tables = get_tables(ctx)
-    tirggers = get_table_triggers(ctx, tables)
-    import ipdb ; ipdb.set_trace()
-    for table in get_tables(ctx):
+    for table in sorted(get_tables(ctx)):
         click.echo("* {}".format(table))
 
 @cli.command()
 @click.pass_context
 def list_triggers(ctx):
     tables = get_tables(ctx)
-    tirggers = get_table_triggers(ctx, tables)
-    for table in get_tables(ctx):
+    triggers = get_table_triggers(ctx, tables)
+    for table in sorted(tables):
         click.echo("* {}".format(table))
+        for trigger_name, event, when in triggers.get(table, ()):
+            click.echo("    {} {} {}".format(when, event, trigger_name))
+
+
+def send_notifications(conn, channel, payloads):
+    """Send every payload to channel with a single statement, delivered
+    when the transaction commits"""
+    if not payloads:
+        return
+    sql = "SELECT " + ", ".join(["pg_notify(%s, %s)"] * len(payloads))
+    params = []
+    for payload in payloads:
+        params.extend((channel, payload))
+    with conn, cursor_wrapper(conn) as cursor:
+        cursor.execute(sql, params)
 
-def iter_events(ctx, channel='events', timeout=None):
-    conn = ctx.obj['CONN']
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+@cli.command()
+@click.argument('channel')
+@click.argument('payloads', nargs=-1)
+@click.pass_context
+def notify(ctx, channel, payloads):
+    send_notifications(ctx.obj.get_notify_conn(), channel, payloads)
+    click.echo("OK: {} notifications".format(len(payloads)))
+
+
+# Specialized per channel by make_drain, a LISTEN on a single channel only
+# ever gets notifications for that channel
+DRAIN_SOURCE = """\
+def drain(notifies):
+    batch = [(n.pid, {channel}, n.payload) for n in notifies]
+    del notifies[:]
+    return batch
+"""
+
+
+@lru_cache(maxsize=None)
+def make_drain(channel=None):
+    """Compile a function emptying conn.notifies into event tuples, with
+    the channel name as a constant when there's a single one"""
+    expression = 'n.channel' if channel is None else repr(channel)
+    code = compile(DRAIN_SOURCE.format(channel=expression),
+                   '<drain {!r}>'.format(channel), 'exec')
+    namespace = {}
+    exec(code, namespace)
+    return namespace['drain']
+
+
+# Sent by the listener process to tell the callback process to exit
+STOP = None
 
+
+def poll_batches(conn, channels, timeout):
+    """Listen on a psycopg2 connection, yielding what each poll() got"""
     curs = conn.cursor()
-    curs.execute("LISTEN {};".format(channel))
+    curs.execute("".join("LISTEN {};".format(quote_ident(channel, curs))
+                         for channel in channels))
+
+    # epoll/kqueue where available, registered once instead of handing the
+    # fd to the kernel again on every wait
+    sel = selectors.DefaultSelector()
+    sel.register(conn, selectors.EVENT_READ)
+
+    # Bound once, this loop is the whole forwarder's critical path
+    select, poll, notifies = sel.select, conn.poll, conn.notifies
+    drain = make_drain(channels[0] if len(channels) == 1 else None)
+    timeout = timeout or None
 
-    print ("Waiting for notifications on channel '{}'".format(channel))
+    print ("Waiting for notifications on channels '{}'".format(", ".join(channels)))
+    try:
+        while True:
+            if not select(timeout):
+                print("Timeout")
+            else:
+                poll()
+                batch = drain(notifies)
+                if batch:
+                    yield batch
+    finally:
+        sel.unregister(conn)
+        sel.close()
+
+
+def listen_query(channels):
+    """LISTEN statements for psycopg 3, sent in a single query"""
+    return sql.SQL(" ").join(sql.SQL("LISTEN {};").format(sql.Identifier(channel))
+                             for channel in channels)
+
+
+def notify_events(conn, channels, timeout):
+    """Listen on a psycopg 3 connection, yielding each notification"""
+    conn.execute(listen_query(channels))
+
+    print ("Waiting for notifications on channels '{}'".format(", ".join(channels)))
     while True:
-        if select.select([conn],[],[],timeout or None) == ([],[],[]):
+        for notify in conn.notifies(timeout=timeout or None):
+            yield (notify.pid, notify.channel, notify.payload)
+        print("Timeout")
+
+
+def notify_batches(conn, channels, timeout):
+    """Listen on a psycopg 3 connection, yielding lists with the first
+    notification and every other one already received"""
+    conn.execute(listen_query(channels))
+    notifies = conn.notifies
+
+    print ("Waiting for notifications on channels '{}'".format(", ".join(channels)))
+    while True:
+        batch = [(notify.pid, notify.channel, notify.payload)
+                 for notify in notifies(timeout=timeout or None, stop_after=1)]
+        if not batch:
             print("Timeout")
-        else:
+            continue
+        # Without waiting, drain what arrived along with the first one
+        batch.extend((notify.pid, notify.channel, notify.payload)
+                     for notify in notifies(timeout=0))
+        yield batch
+
+
+def listen_batches(conn, channels, timeout=None):
+    """Yield lists with every notification received in a single poll()"""
+    if psycopg is None:
+        return poll_batches(conn, channels, timeout)
+    return notify_batches(conn, channels, timeout)
+
+
+def listen_events(conn, channels, timeout=None):
+    if psycopg is None:
+        return (event
+                for batch in poll_batches(conn, channels, timeout)
+                for event in batch)
+    return notify_events(conn, channels, timeout)
+
+
+def iter_batches(ctx, channels, timeout=None):
+    return listen_batches(ctx.obj.get_listen_conn(), channels, timeout)
+
+
+def iter_events(ctx, channels, timeout=None):
+    return listen_events(ctx.obj.get_listen_conn(), channels, timeout)
+
+
+async def apoll_events(conn, channels, timeout):
+    """Listen on a psycopg2 connection, woken up by the running event loop"""
+    curs = conn.cursor()
+    curs.execute("".join("LISTEN {};".format(quote_ident(channel, curs))
+                         for channel in channels))
+
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    loop.add_reader(conn, readable.set)
+    drain = make_drain(channels[0] if len(channels) == 1 else None)
+
+    print ("Waiting for notifications on channels '{}'".format(", ".join(channels)))
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(readable.wait(), timeout or None)
+            except asyncio.TimeoutError:
+                print("Timeout")
+                continue
+            readable.clear()
             conn.poll()
-            while conn.notifies:
-                notify = conn.notifies.pop(0)
+            for event in drain(conn.notifies):
+                yield event
+    finally:
+        loop.remove_reader(conn)
+
+
+async def anotify_events(dsn, channels, timeout):
+    """Listen on a psycopg 3 async connection"""
+    conn = await psycopg.AsyncConnection.connect(dsn, autocommit=True)
+    async with conn:
+        await conn.execute(listen_query(channels))
+
+        print ("Waiting for notifications on channels '{}'".format(", ".join(channels)))
+        while True:
+            async for notify in conn.notifies(timeout=timeout or None):
                 yield (notify.pid, notify.channel, notify.payload)
+            print("Timeout")
+
+
+async def aiter_events(ctx, channels, timeout=None):
+    """Async version of iter_events"""
+    if psycopg is None:
+        events = apoll_events(ctx.obj.get_listen_conn(), channels, timeout)
+    else:
+        # Async connections can't be shared with the sync listener
+        events = anotify_events(ctx.obj.dsn, channels, timeout)
+    async for event in events:
+        yield event
+
+
+async def dispatch_events(ctx, function, channels, timeout=None):
+    """Feed events to function, awaiting it if it's a coroutine function"""
+    is_coro = asyncio.iscoroutinefunction(function)
+    async for event in aiter_events(ctx, channels=channels, timeout=timeout):
+        if is_coro:
+            await function(event)
+        else:
+            function(event)
+
+
+def set_uring_policy():
+    """Install uringcore's io_uring event loop policy"""
+    try:
+        import uringcore
+    except ImportError:
+        raise click.BadArgumentUsage("--io-uring requires uringcore to be installed")
+    asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+
+
+def jit_compile(function):
+    """Compile a callback in nopython mode with numba"""
+    try:
+        import numba
+    except ImportError:
+        raise click.BadArgumentUsage("--jit requires numba to be installed")
+    return numba.njit(cache=True)(function)
+
+
+def load_callback(path, jit=False):
+    """Import a callback given as module.function"""
+    mod_name, func_name = path.rsplit('.', 1)
+    mod = importlib.import_module(mod_name)
+    function = getattr(mod, func_name, None)
+    if not callable(function):
+        raise click.BadArgumentUsage("{} could not be imported".format(path))
+    if jit:
+        function = jit_compile(function)
+    return function
+
+
+def finish_callback(path):
+    """Call teardown() from the callback's module if it has one, atexit
+    handlers don't run in multiprocessing children"""
+    mod = importlib.import_module(path.rsplit('.', 1)[0])
+    teardown = getattr(mod, 'teardown', None)
+    if callable(teardown):
+        teardown()
+
+
+# The --ipc callback processes only get picklable arguments (callback path),
+# so they also work with the spawn and forkserver start methods
+
+def consume(get, callback, jit):
+    """Call the callback on everything get() returns until STOP or EOF.
+    A failing event is reported and skipped, so the listener never blocks
+    on a consumer that died"""
+    # Ctrl-C reaches the whole process group, the listener sends STOP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    function = load_callback(callback, jit)
+    try:
+        while True:
+            try:
+                element = get()
+            except EOFError:
+                break
+            if element is STOP:
+                break
+            try:
+                function(element)
+            except Exception:
+                traceback.print_exc()
+    finally:
+        finish_callback(callback)
+
+
+def pipe_to_callback(receiver, callback, jit):
+    """Callback process, calls the callback on every event received"""
+    consume(receiver.recv, callback, jit)
+
+
+def queue_to_callback(queue, callback, jit):
+    """Worker process, one of several sharing the same queue"""
+    consume(queue.get, callback, jit)
+
+
+def feed_pipe(events, callback, jit):
+    """Send events to a single callback process, keeping their order.
+    One producer, one consumer: a simplex pipe is enough, no lock or
+    feeder thread as with multiprocessing.Queue"""
+    receiver, sender = Pipe(duplex=False)
+    consumer = Process(target=pipe_to_callback, args=(receiver, callback, jit))
+    consumer.start()
+    # Only the consumer keeps this end open, so a send fails instead of
+    # blocking if it dies
+    receiver.close()
+    try:
+        for event in events:
+            sender.send(event)
+    finally:
+        try:
+            sender.send(STOP)
+        except OSError:
+            # The callback process is already gone, don't hide the
+            # error that got us here
+            pass
+        sender.close()
+        consumer.join()
+
+
+def put_while_alive(queue, element, workers):
+    """Put element on a bounded queue, giving up (returning False) once
+    no worker is left to take it"""
+    while True:
+        try:
+            queue.put(element, timeout=1)
+            return True
+        except Full:
+            if not any(worker.is_alive() for worker in workers):
+                return False
+
+
+def feed_workers(events, callback, jit, workers):
+    """Hand events to whichever of several callback processes is free.
+    Workers exit on STOP, once they drained what was queued before it"""
+    queue = Queue(maxsize=workers * 64)
+    pool = [Process(target=queue_to_callback, args=(queue, callback, jit))
+            for _ in range(workers)]
+    for worker in pool:
+        worker.start()
+    try:
+        for event in events:
+            if not put_while_alive(queue, event, pool):
+                raise click.ClickException("Every callback worker exited")
+    finally:
+        for worker in pool:
+            if not put_while_alive(queue, STOP, pool):
+                break
+        for worker in pool:
+            worker.join()
+        # Anything left belongs to workers that died, don't wait to flush it
+        queue.cancel_join_thread()
 
 
 @cli.command()
@@ -190,48 +682,76 @@ def get_triggers(ctx, ):
         click.echo(cursor.fetchall())
 
 @cli.command()
+@click.option('--channel', 'channels', type=str, multiple=True,
+              help="Channel to LISTEN on, can be repeated. Defaults to every "
+                   "table, as the triggers notify on a channel per table")
 @click.option('--timeout', type=int, default=0)
-@click.option('--callback', type=str, default=None, help="Python function to call")
-@click.option('--ipc', is_flag=True, help="Run callback in another process")
+@click.option('--callback', type=str, default=None,
+              help="Python function to call, as module.function. With --ipc, "
+                   "the module's teardown() is called when its process stops")
+@click.option('--ipc', is_flag=True, help="Run callback in other processes")
+@click.option('--workers', type=click.IntRange(min=1),
+              default=os.cpu_count() or 1,
+              help="Callback processes for --ipc, one per CPU by default. "
+                   "Events may be handled out of order, use --workers 1 to "
+                   "keep it")
+@click.option('--jit', is_flag=True,
+              help="Compile the callback with numba.njit. Only helps numeric "
+                   "callbacks, string handling won't get faster")
+@click.option('--batch', is_flag=True,
+              help="Call the callback once per poll with a list of events")
+@click.option('--aio', is_flag=True, help="Listen from an asyncio event loop")
+@click.option('--io-uring', is_flag=True,
+              help="Run the asyncio loop on io_uring (Linux 5.11+, needs uringcore)")
 @click.pass_context
-def watch(ctx, timeout, callback, ipc):
+def watch(ctx, channels, timeout, callback, ipc, workers, jit, batch, aio,
+          io_uring):
     function = None
+    if jit and not callback:
+        raise click.BadArgumentUsage("JIT specified but no callback")
     if callback:
-        mod_name, func_name = callback.rsplit('.', 1)
-        mod = importlib.import_module(mod_name)
-        function = getattr(mod, func_name, None)
-        if not callable(function):
-            raise click.BadArgumentUsage("{} could not be imported".format(callback))
+        function = load_callback(callback, jit)
+
+    if io_uring:
+        set_uring_policy()
+        aio = True
 
-    if ipc:
+    if not channels:
+        channels = sorted(get_tables(ctx))
+        if not channels:
+            raise click.BadArgumentUsage("No tables to listen on, use --channel")
+    channels = tuple(channels)
+
+    if batch and not function:
+        raise click.BadArgumentUsage("Batch specified but no callback")
+    source = iter_batches if batch else iter_events
+
+    if aio:
+        if ipc or batch:
+            raise click.BadArgumentUsage("--ipc and --batch can't be combined with --aio")
         if not function:
-            raise click.BadArgumentUsage("IPC specified but no callback")
+            function = lambda event: click.echo("Received event: {}".format(event))
+        asyncio.run(dispatch_events(ctx, function, channels=channels,
+                                    timeout=timeout))
 
-        def listen_to_queue(queue, ctx):
-            for event in iter_events(ctx):
-                queue.put(event)
-        def queue_to_callback(queue):
-            while True:
-                element = queue.get()
-                function(element)
-        queue = Queue()
-        back = Process(target=listen_to_queue, args=(queue, ctx))
-        front = Process(target=queue_to_callback, args=(queue, ))
-        back.join()
-        front.join()
+    elif ipc:
+        if not function:
+            raise click.BadArgumentUsage("IPC specified but no callback")
+        # The listener stays in this process, so Ctrl-C or an error stops it
+        # right away and the callback processes are told to exit
+        events = source(ctx, channels=channels, timeout=timeout)
+        if workers == 1:
+            feed_pipe(events, callback, jit)
+        else:
+            feed_workers(events, callback, jit, workers)
 
     elif function:
-        for event in iter_events(ctx):
+        for event in source(ctx, channels=channels, timeout=timeout):
             function(event)
     else:
-        for event in iter_events(ctx):
+        for event in iter_events(ctx, channels=channels, timeout=timeout):
             click.echo("Received event: {}".format(event))
 
 
-class AttrDict(dict):
-    """Use dot notation instead of inexing"""
-    __getattr__ = dict.__getitem__
-
-
 if __name__ == '__main__':
-    cli(obj=AttrDict())
+    cli()
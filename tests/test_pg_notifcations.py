@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pg_notifcations
+----------------------------------
+
+Tests for the triggers installed by `src/pg_notifcations.py`. They need a
+PostgreSQL database to install them in, given with PG_NOTIFICATIONS_DSN.
+"""
+
+import json
+import os
+import select
+import sys
+
+import pytest
+
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import pg_notifcations  # noqa: E402
+
+
+DSN = os.environ.get('PG_NOTIFICATIONS_DSN')
+
+pytestmark = pytest.mark.skipif(not DSN, reason="PG_NOTIFICATIONS_DSN not set")
+
+TABLE = 'pg_notifications_test'
+
+# Notified after each statement, everything before it has been delivered
+DONE = 'done'
+
+
+def connect():
+    conn = pg_notifcations.psycopg2.connect(DSN)
+    conn.autocommit = True
+    return conn
+
+
+@pytest.fixture
+def conn():
+    conn = connect()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(params=[[], ['--per-row']], ids=['statement', 'per-row'])
+def table(request, conn):
+    """A table with json and point columns, which have no equality
+    operator, with the triggers installed"""
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {0};"
+                       "CREATE TABLE {0} (id int, data text, j json, p point)"
+                       .format(TABLE))
+    result = CliRunner().invoke(pg_notifcations.cli,
+                                ['--conn', DSN, 'install'] + request.param
+                                + [TABLE])
+    assert result.exit_code == 0, result.output
+    yield request.param
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE {}".format(TABLE))
+
+
+@pytest.fixture
+def listener(table):
+    listener = connect()
+    with listener.cursor() as cursor:
+        cursor.execute("LISTEN {}".format(TABLE))
+    yield listener
+    listener.close()
+
+
+def execute(conn, listener, query, params=None):
+    """Run query and return the payloads it got notified, in order"""
+    with conn.cursor() as cursor:
+        cursor.execute(query, params)
+        cursor.execute("SELECT pg_notify(%s, %s)", (TABLE, DONE))
+    payloads = []
+    while True:
+        assert select.select([listener], [], [], 5) != ([], [], []), \
+            "Timed out waiting for notifications"
+        listener.poll()
+        while listener.notifies:
+            payload = listener.notifies.pop(0).payload
+            if payload == DONE:
+                return payloads
+            payloads.append(payload)
+
+
+def test_install_notifies_rows(conn, listener):
+    payloads = execute(conn, listener,
+                       "INSERT INTO {} VALUES (1, 'a', '{{\"a\": 1}}', "
+                       "point(1, 2))".format(TABLE))
+    assert [json.loads(payload) for payload in payloads] == [{
+        'table': TABLE,
+        'action': 'INSERT',
+        'data': [{'id': 1, 'data': 'a', 'j': {'a': 1}, 'p': '(1,2)'}],
+    }]
+
+
+def test_update_with_json_and_point_columns(conn, listener):
+    execute(conn, listener,
+            "INSERT INTO {} VALUES (1, 'a', NULL, NULL)".format(TABLE))
+
+    # Unchanged rows aren't notified, and don't need an equality operator
+    assert execute(conn, listener,
+                   "UPDATE {} SET id = id".format(TABLE)) == []
+
+    payloads = execute(conn, listener,
+                       "UPDATE {} SET j = '[1]', p = point(3, 4)"
+                       .format(TABLE))
+    assert [json.loads(payload)['data'] for payload in payloads] == [
+        [{'id': 1, 'data': 'a', 'j': [1], 'p': '(3,4)'}],
+    ]
+
+
+def test_large_statements_are_split(conn, listener, table):
+    if table:
+        pytest.skip("Only statement triggers batch rows")
+    payloads = execute(conn, listener,
+                       "INSERT INTO {} SELECT g, repeat('x', 50) "
+                       "FROM generate_series(1, 200) g".format(TABLE))
+    assert len(payloads) > 1
+    assert all(len(payload.encode()) < 8000 for payload in payloads)
+    ids = [row['id']
+           for payload in payloads
+           for row in json.loads(payload)['data']]
+    assert sorted(ids) == list(range(1, 201))